@@ -25,71 +25,112 @@ import os
 import re
 import sys
 import copy
+import functools
+import shlex
+import zipfile
 import subprocess
 
 import argparse as ap
+import multiprocessing as mp
 import numpy as np
+import matplotlib
+
+matplotlib.use('Agg')
+
 import matplotlib.pyplot as plt
 
+from collections import defaultdict
 from matplotlib import cm
 from matplotlib.colors import LogNorm
 from tqdm.auto import tqdm
 
+try:
+	import pandas as pd
+except ImportError:
+	pd = None
+
+#Run number of ascii spectra
+_RUN_RE = re.compile(r'(\d{3})(?=_det\d+\.txt$)')
+
+#Modified colormap
+_CMAP = copy.copy(cm.viridis)
+_CMAP.set_under(color='white')
+
+#Axes reused for all plots of a process
+_AX = None
+
 #---------------------------------------------------------------------------------------#
 #		Commands cmat
 #---------------------------------------------------------------------------------------#
 
-def write_cmat_commands(in_run,in_args):
+def write_cmat_commands(in_runs,in_args):
 	'''Load matrices in cmat and gate on the individual detectors.
 	Store the resulting 1d spetra in the current working directory
-	(i.e. where drift_check.py is called).'''
+	(i.e. where drift_check.py is called).
+	The commands for all runs are returned as a single string for cmat.'''
 
-	out_string  = 'cmat -l << echo\n'
-	out_string += 'o %s\n'% in_run
+	out_string  = ''
 
-	for det in range(in_args.num_dets):
+	for run in in_runs:
 
-		out_string += 'gate\n'
-		out_string += '2\n'
-		out_string += '\n'
-		out_string += '%i %i\n'% (det,det)
-		out_string += '\n'
-		out_string += '\n'
-		out_string += '%s_det%02i|l:8\n'% (in_run,det+1)
+		out_string += 'o %s\n'% run
 
-	out_string += 'q\necho'
+		for det in range(in_args.num_dets):
 
-	with open(os.path.join(in_args.head,'split_run.sh'),'w') as file:
-		file.write(out_string)
+			out_string += 'gate\n'
+			out_string += '2\n'
+			out_string += '\n'
+			out_string += '%i %i\n'% (det,det)
+			out_string += '\n'
+			out_string += '\n'
+			out_string += '%s_det%02i|l:8\n'% (run,det+1)
 
-	return
+	out_string += 'q\n'
+
+	return out_string
 
 #---------------------------------------------------------------------------------------#
 #		Split and convert matrices
 #---------------------------------------------------------------------------------------#
 
-def split_matrices(in_args):
-	'''Identify all needed runs in the current working directory.
+def split_matrices(in_cmds,in_pattern,in_args):
+	'''Identify all needed runs in the current working directory
+	using the compiled pattern in_pattern.
 	Since cmat does not accept arbitrarily long path names for matrices,
 	all cmat operations are performed in the data directory.
 	Split and convert runs to .txt and move them to the destination directory.'''
 
-	subprocess.call(['cd %s && chmod +x split_run.sh && ./split_run.sh'% in_args.head],
-			shell=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+	try:
+		split 	= subprocess.run(['cmat','-l'],input=in_cmds,text=True,cwd=in_args.head,
+				stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+	except FileNotFoundError:
+		sys.exit('ERROR: cmat not found.')
+
+	if split.returncode != 0:
+		sys.exit('ERROR: Splitting matrices with cmat failed in path %s/.'% (in_args.head))
 
-	runs_split	= [file for file in os.listdir(in_args.head)
-				if re.search(in_args.tail+'[0-9]{3}_det[0-9]{2}$',file)]
+	runs_split	= [file for file in os.listdir(in_args.head) if in_pattern.search(file)]
 
 	if runs_split == []:
 		sys.exit('ERROR: Found no runs to split in path %s/.'% (in_args.head))
 
+	#Convert all spectra in a single shell, the script is passed via stdin
+	#since it may exceed the maximum length of a single argument.
+	#Each mkascii16k reads from /dev/null so it cannot consume the script,
+	#and the shell stops at the first failing conversion.
+	convert		= 'set -e\n'+'\n'.join('mkascii16k %s %s </dev/null'% (
+				shlex.quote(os.path.join(in_args.head,run)),
+				shlex.quote(os.path.join(in_args.dest,run+'.txt'))) for run in runs_split)
+
+	conversion 	= subprocess.run(['sh'],input=convert,text=True,
+				stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+
+	if conversion.returncode != 0:
+		sys.exit('ERROR: Converting spectra with mkascii16k failed in path %s/.'% (in_args.head))
+
 	for run in runs_split:
 
-		subprocess.call(['mkascii16k %s %s'% (os.path.join(in_args.head,run),
-				os.path.join(in_args.dest,run+'.txt'))],
-				shell=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
-		subprocess.call(['rm %s'% os.path.join(in_args.head,run)],
-				shell=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+		os.remove(os.path.join(in_args.head,run))
 
 	return
 
@@ -97,151 +138,269 @@ def split_matrices(in_args):
 #		Load spectra (.txt files)
 #---------------------------------------------------------------------------------------#
 
-def load_spectra(in_det,in_args):
+def _read_col1(path,a,b):
+	'''Read the counts (second column) of an ascii spectrum in the range [a,b).
+	Use the C parser of pandas if available, otherwise fall back to numpy.
+	Lines outside of the range are not parsed.'''
+
+	if pd is not None:
+		return pd.read_csv(path,sep=r'\s+',header=None,usecols=[1],skiprows=a,nrows=b-a,
+				dtype=np.float32,engine='c').values[:,0]
+
+	return np.loadtxt(path,usecols=(1),skiprows=a,max_rows=b-a,dtype=np.float32)
+
+def load_spectra(in_det,in_files,in_args):
 	'''Load all run spectra for a given detector and store them in a matrix.
-	Only take into account the requested range of the spectrum.'''
+	Only take into account the requested range of the spectrum.
+	The ascii spectra are taken from in_files, mapping detector numbers to paths.'''
 
 	#Identify files
-	runs_txt 	= [os.path.join(in_args.dest,file) for file in os.listdir(in_args.dest)
-				if re.search(in_args.tail+'[0-9]{3}_det%02i.txt$'% (in_det+1),file)]
+	runs_txt 	= in_files.get(in_det+1,[])
+	run_numbers 	= [int(_RUN_RE.search(run).group(1)) for run in runs_txt]
+
+	#Reuse cached matrix if it is not older than the ascii spectra
+	#and was created from the same runs
+	cache 		= os.path.join(in_args.dest,in_args.tail+'det%02i_%i-%i.npz'% (in_det+1,*in_args.range))
+	use_cache 	= False
+
+	if in_args.cache and os.path.isfile(cache) and (runs_txt == [] or
+			max(os.path.getmtime(run) for run in runs_txt) <= os.path.getmtime(cache)):
+
+		#Unreadable cache files are treated as missing
+		try:
+			with np.load(cache) as data:
+
+				if runs_txt == [] or np.array_equal(data['runs'],sorted(run_numbers)):
+
+					matrix 		= data['matrix']
+					max_run 	= matrix.shape[1]
+					use_cache 	= True
+
+		except (OSError,ValueError,KeyError,zipfile.BadZipFile):
+			use_cache 	= False
+
+	if not use_cache:
+
+		if runs_txt == []:
+			sys.exit('ERROR: Found no ascii spectra in path %s.\n\
+				Maybe run DriftCheck with option --full.'% (in_args.dest))
+
+		#Read spectra ordered by run number
+		runs_sorted 	= sorted(zip(run_numbers,runs_txt))
+		spectra 	= [_read_col1(run,in_args.range[0],in_args.range[1]) for _,run in runs_sorted]
+		max_run 	= runs_sorted[-1][0]
+
+		#Build matrix (channel x run), only columns of missing runs are set to zero
+		if [run_number for run_number,_ in runs_sorted] == list(range(1,max_run+1)):
+
+			matrix 	= np.stack(spectra,axis=1)
+
+		else:
 
-	if runs_txt == []:
-		sys.exit('ERROR: Found no ascii spectra in path %s.\n\
-			Maybe run DriftCheck with option --full.'% (in_args.dest))
+			matrix 	= np.empty((in_args.range[1]-in_args.range[0],max_run),dtype=np.float32)
 
-	#Initialize matrix
-	max_run 	= np.max([int(re.search('[0-9]{3}(?=_det[0-9]+.txt$)',run).group(0)) 
-					for run in runs_txt])
-	matrix 		= np.zeros((max_run,int(np.diff(in_args.range))))
+			matrix[:,np.setdiff1d(np.arange(max_run),np.array(run_numbers)-1)] = 0
 
-	for run in runs_txt:
+			for (run_number,_),spectrum in zip(runs_sorted,spectra):
 
-		run_number 		= int(run.split('_')[-2])
-		matrix[run_number-1]	= np.loadtxt(run,usecols=(1))[in_args.range[0]:in_args.range[1]]
+				matrix[:,run_number-1] 	= spectrum
+
+		#Write to a temporary file first, so an interrupted worker leaves no broken cache
+		if in_args.cache:
+
+			cache_tmp 	= '%s.%i.tmp'% (cache,os.getpid())
+
+			with open(cache_tmp,'wb') as file:
+				np.savez(file,matrix=matrix,runs=np.array(sorted(run_numbers)))
+
+			os.replace(cache_tmp,cache)
 
 	#Save matrix entries
-	if args.write:
-		np.savetxt(os.path.join(in_args.dest,in_args.tail+'det%02i.mat'% (in_det+1)),matrix.T)
+	if in_args.write:
+		np.savetxt(os.path.join(in_args.dest,in_args.tail+'det%02i.mat'% (in_det+1)),matrix)
 
-	return max_run,matrix.T
+	return max_run,matrix
 
 #---------------------------------------------------------------------------------------#
 #		Prepare plots
 #---------------------------------------------------------------------------------------#
 
-def prepare_plots(in_det,in_args):
-	'''Prepare a spectrum-over-run number matrix for a given detector.'''
+def prepare_plots(in_det,in_files,in_args,in_ax):
+	'''Prepare a spectrum-over-run number matrix for a given detector.
+	The plot is drawn on in_ax, which is cleared afterwards for reuse.'''
 
 	#Load all runs
-	max_run,matrix 	= load_spectra(in_det=in_det,in_args=in_args)
+	max_run,matrix 	= load_spectra(in_det=in_det,in_files=in_files,in_args=in_args)
 
-	#Modify colormap
-	cmap = copy.copy(cm.viridis)
-	cmap.set_under(color='white')
+	#Map counts to 8-bit RGBA colors before handing them to matplotlib
+	mn,mx 	= matrix.min(),matrix.max()
+	norm 	= LogNorm(vmin=mn+1,vmax=mx)
+	rgba 	= _CMAP(norm(matrix),bytes=True)
 
 	#Prepare plot
-	plt.figure(figsize=(10,5))
-
-	plt.imshow(matrix,
+	in_ax.imshow(rgba,
 		aspect='auto',
 		origin='lower',
 		extent=(0,max_run,in_args.range[0],in_args.range[1]),
 		#interpolation='nearest',
-		#cmap='viridis',
-		cmap=cmap,
-		norm=LogNorm(vmin=matrix[in_args.range[0]:in_args.range[1]].min()+1,
-				vmax=matrix[in_args.range[0]:in_args.range[1]].max()),
+		rasterized=True,
 		)
 
-	plt.text(0.95*max_run,0.9*in_args.range[1],'Det %i'% (in_det+1),
+	in_ax.text(0.95*max_run,0.9*in_args.range[1],'Det %i'% (in_det+1),
 				fontsize=20,color='white',ha='right',
 				#bbox=dict(boxstyle='round',facecolor='white',edgecolor='white',alpha=0.5)
 				)
 
-	plt.xlim(0,max_run)
-	plt.ylim(in_args.range[0],in_args.range[1])
+	in_ax.set_xlim(0,max_run)
+	in_ax.set_ylim(in_args.range[0],in_args.range[1])
+
+	in_ax.set_xlabel('Run',fontsize=16)
+	in_ax.set_ylabel('Channel',fontsize=16)
+	in_ax.tick_params(axis='both',which='major',labelsize=16)
+
+	in_ax.figure.savefig(os.path.join(in_args.dest,'det%i.%s'% (in_det+1,in_args.format)),dpi=150)
+	in_ax.clear()
+
+def compute_layout(in_args):
+	'''Compute the subplot parameters shared by all plots.
+	A dummy plot with the same labels and ticks is laid out once,
+	with a tick label at the right edge at least as wide as for any
+	(three-digit) run number.'''
+
+	fig,ax = plt.subplots(figsize=(10,5))
+
+	ax.set_xlim(0,1000)
+	ax.set_ylim(in_args.range[0],in_args.range[1])
+
+	ax.set_xlabel('Run',fontsize=16)
+	ax.set_ylabel('Channel',fontsize=16)
+	ax.tick_params(axis='both',which='major',labelsize=16)
+
+	fig.tight_layout()
+
+	pars 	= fig.subplotpars
+	plt.close(fig)
+
+	return dict(left=pars.left,right=pars.right,bottom=pars.bottom,top=pars.top)
 
-	plt.xlabel('Run',fontsize=16)
-	plt.ylabel('Channel',fontsize=16)
-	plt.tick_params(axis='both',which='major',labelsize=16)
+def init_worker(in_layout):
+	'''Create the figure reused for all plots of a worker process.'''
 
-	plt.tight_layout()
+	global _AX
 
-	plt.savefig(os.path.join(in_args.dest,'det%i.pdf'% (in_det+1)))
-	plt.close()
+	fig,_AX = plt.subplots(figsize=(10,5))
+	fig.subplots_adjust(**in_layout)
+
+def plot_detector(in_det,in_files,in_args):
+	'''Run prepare_plots for a given detector in a worker process.
+	Errors are returned to the main process instead of exiting,
+	since a worker leaving via sys.exit would stall the pool.'''
+
+	try:
+		prepare_plots(in_det=in_det,in_files=in_files,in_args=in_args,in_ax=_AX)
+	except SystemExit as error:
+		return error.code
+
+	return None
 
 #---------------------------------------------------------------------------------------#
 #		Main
 #---------------------------------------------------------------------------------------#
 
-#----- Parse arguments -----#
+if __name__ == '__main__':
 
-argparser = ap.ArgumentParser(description='Create spectra over run number from GASPware matrices.')
+	#----- Parse arguments -----#
 
-argparser.add_argument('pattern',	metavar='PATTERN',type=str,
-					help='path to and name pattern of matrices')
-argparser.add_argument('--full',	dest='full',action='store_true',
-					help='create .txt files from matrices')
-argparser.add_argument('--write',	dest='write',action='store_true',
-					help='store raw data of plots in .mat files')
-argparser.add_argument('--clear',	dest='clear',action='store_true',
-					help='delete created .txt files')
-argparser.add_argument('--dest',	dest='dest',metavar='DESTINATION',type=str,default=os.getcwd(),
-					help='path where output is stored (default: current location)')
-argparser.add_argument('--dets', 	dest='num_dets',metavar='NUM DETS',type=int,default=25,
-					help='number of detectors (default: 25)')
-argparser.add_argument('--range',	dest='range',metavar='RANGE',type=int,nargs=2,default=[0,8191],
-					help='plot range for data axis (default: 0 8191)')
+	argparser = ap.ArgumentParser(description='Create spectra over run number from GASPware matrices.')
 
-args		= argparser.parse_args()
+	argparser.add_argument('pattern',	metavar='PATTERN',type=str,
+						help='path to and name pattern of matrices')
+	argparser.add_argument('--full',	dest='full',action='store_true',
+						help='create .txt files from matrices')
+	argparser.add_argument('--write',	dest='write',action='store_true',
+						help='store raw data of plots in .mat files')
+	argparser.add_argument('--clear',	dest='clear',action='store_true',
+						help='delete created .txt files')
+	argparser.add_argument('--no-cache',	dest='cache',action='store_false',
+						help='ignore and do not create cached .npz files')
+	argparser.add_argument('--dest',	dest='dest',metavar='DESTINATION',type=str,default=os.getcwd(),
+						help='path where output is stored (default: current location)')
+	argparser.add_argument('--format',	dest='format',type=str,choices=['png','pdf'],default='png',
+						help='file format of plots (default: png)')
+	argparser.add_argument('--dets', 	dest='num_dets',metavar='NUM DETS',type=int,default=25,
+						help='number of detectors (default: 25)')
+	argparser.add_argument('--range',	dest='range',metavar='RANGE',type=int,nargs=2,default=[0,8191],
+						help='plot range for data axis (default: 0 8191)')
 
-#----- Separate file pattern and data path -----#
+	args		= argparser.parse_args()
 
-args.head 	= os.path.abspath(os.path.split(args.pattern)[0])
-args.tail 	= os.path.split(args.pattern)[1]
-args.dest	= os.path.abspath(args.dest)
+	if args.num_dets < 1:
+		argparser.error('NUM DETS must be at least 1')
 
-#----- Create .txt files -----#
+	#----- Separate file pattern and data path -----#
 
-if args.full:
+	args.head 	= os.path.abspath(os.path.split(args.pattern)[0])
+	args.tail 	= os.path.split(args.pattern)[1]
+	args.dest	= os.path.abspath(args.dest)
 
-	#Identify files
-	runs_cmat	= [file for file in os.listdir(args.head)
-					if re.search(args.tail+'[0-9]{3}.cmat$',file)]
+	#----- Compile file name patterns -----#
+
+	CMAT_RE 	= re.compile(r'%s\d{3}\.cmat$'% re.escape(args.tail))
+	SPLIT_RE 	= re.compile(r'%s\d{3}_det\d{2}$'% re.escape(args.tail))
+	TXT_RE 		= re.compile(r'%s(\d{3})_det(\d{2})\.txt$'% re.escape(args.tail))
+
+	#----- Create .txt files -----#
+
+	if args.full:
+
+		#Identify files
+		runs_cmat	= [file for file in os.listdir(args.head) if CMAT_RE.search(file)]
+
+		if runs_cmat == []:
+			sys.exit('ERROR: Found no files matching pattern %s in path %s/.'% (args.tail,args.head))
+
+		print('Splitting matrices...')
+
+		#Split matrices
+		cmds 	= write_cmat_commands(in_runs=[os.path.splitext(run)[0] for run in runs_cmat],in_args=args)
+		split_matrices(in_cmds=cmds,in_pattern=SPLIT_RE,in_args=args)
+
+	#----- Identify .txt files -----#
+
+	files_det 	= defaultdict(list)
 
-	if runs_cmat == []:
-		sys.exit('ERROR: Found no files matching pattern %s in path %s/.'% (args.tail,args.head))
+	with os.scandir(args.dest) as entries:
+		files_txt 	= [entry.name for entry in entries
+					if entry.name.endswith('.txt') and args.tail in entry.name]
 
-	print('Splitting matrices...')
+	for file in files_txt:
 
-	#Split matrices
-	for run in tqdm(runs_cmat):
+		match 	= TXT_RE.search(file)
 
-		write_cmat_commands(in_run=run.split('.')[0],in_args=args)
-		split_matrices(in_args=args)
+		if match:
+			files_det[int(match.group(2))].append(os.path.join(args.dest,file))
 
-#----- Run for each detector -----#
+	#----- Run for each detector -----#
 
-print('Preparing plots...')
+	print('Preparing plots...')
 
-for det in tqdm(range(args.num_dets)):
+	with mp.get_context('spawn').Pool(processes=min(os.cpu_count() or 1,args.num_dets),
+				initializer=init_worker,initargs=(compute_layout(in_args=args),)) as pool:
 
-	prepare_plots(in_det=det,in_args=args)
+		for error in tqdm(pool.imap_unordered(functools.partial(plot_detector,in_files=files_det,in_args=args),
+					range(args.num_dets)),total=args.num_dets):
 
-#----- Clear .txt files -----#
+			if error is not None:
+				sys.exit(error)
 
-if args.clear:
+	#----- Clear .txt files -----#
 
-	print('Cleaning up...')
+	if args.clear:
 
-	#Delete split_run.sh
-	subprocess.call(['rm %s'% (os.path.join(args.head,'split_run.sh'))],
-			shell=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+		print('Cleaning up...')
 
-	#Delete .txt-files without exceeding the bash input limit
-	files_txt 	= [file for file in os.listdir(args.dest)
-				if re.search(args.tail+'[0-9]{3}_det[0-9]{2}.txt$',file)]
+		#Delete .txt-files
+		files_txt 	= [file for file in os.listdir(args.dest) if TXT_RE.search(file)]
 
-	subprocess.call(['cd %s && rm %s'% (args.dest,' '.join(files_txt))],
-			shell=True,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
-	
+		for file in files_txt:
+			os.remove(os.path.join(args.dest,file))